@@ -1,9 +1,10 @@
 import os
-import glob
+import asyncio
 import logging
 import base64
+import uuid
 from io import BytesIO
-from typing import List, Optional
+from typing import List, Optional, Set
 
 # LangChain & OpenAI
 from langchain_openai import ChatOpenAI
@@ -29,6 +30,20 @@ if OPENAI_API_KEY == "VOTRE_CLE_API_OPENAI_ICI":
 BASE_INPUT_DIR = r"C:\Users\DELL\Desktop\CampusGPT\doc"
 BASE_OUTPUT_DIR = r"C:\Users\DELL\Desktop\CampusGPT\doc_md_gpt_vision"
 SUPPORTED_EXTENSIONS = ['.pdf', '.png', '.jpg', '.jpeg']
+# Par défaut, les fichiers dont le Markdown existe déjà sont ignorés.
+# Mettre à True pour tout regénérer (ex. après une modification du prompt ou du schéma).
+OVERWRITE_EXISTING = False
+# Nombre maximal de fichiers traités (et d'appels GPT-4o Vision) en parallèle.
+# À réduire si votre palier d'API OpenAI renvoie des erreurs 429 (limite de tokens par minute).
+MAX_CONCURRENT_REQUESTS = 8
+# Nouvelles tentatives (avec attente exponentielle) par appel à l'API, notamment sur les erreurs 429
+MAX_RETRIES = 6
+# Nombre maximal de fichiers convertis en images en même temps. Chaque conversion de PDF utilise déjà
+# PDF_CONVERSION_THREADS processus pdftoppm : sans cette limite, les MAX_CONCURRENT_REQUESTS tâches
+# lanceraient leurs rendus simultanément (au démarrage notamment) et satureraient CPU et mémoire.
+MAX_CONCURRENT_RENDERS = 1
+# Processus pdftoppm utilisés pour rendre les pages d'un PDF (pdf2image le limite au nombre de pages)
+PDF_CONVERSION_THREADS = os.cpu_count() or 1
 
 # --- 1. Définition de la Structure de Sortie avec Pydantic ---
 
@@ -64,18 +79,18 @@ def get_images_from_file(filepath: str) -> List[str]:
     try:
         if filepath.lower().endswith('.pdf'):
             # Convertit chaque page du PDF en image
-            pages = convert_from_path(filepath)
+            pages = convert_from_path(filepath, thread_count=PDF_CONVERSION_THREADS)
             for page in pages:
                 base64_images.append(image_to_base64_uri(page))
-            logging.info(f"{len(pages)} pages converties en images pour {os.path.basename(filepath)}.")
+            logging.info("%d pages converties en images pour %s.", len(pages), os.path.basename(filepath))
         elif filepath.lower().endswith(('.png', '.jpg', '.jpeg')):
             # Charge l'image directement
             with Image.open(filepath) as img:
                 base64_images.append(image_to_base64_uri(img))
-            logging.info(f"Image chargée : {os.path.basename(filepath)}.")
+            logging.info("Image chargée : %s.", os.path.basename(filepath))
         return base64_images
     except Exception as e:
-        logging.error(f"Erreur lors de la conversion du fichier {filepath} en image(s): {e}")
+        logging.error("Erreur lors de la conversion du fichier %s en image(s): %s", filepath, e)
         logging.error("Assurez-vous que Poppler est installé et dans le PATH de votre système.")
         return []
 
@@ -84,7 +99,8 @@ def get_images_from_file(filepath: str) -> List[str]:
 def get_structured_extraction_chain():
     """Configure et retourne la chaîne LangChain pour l'extraction multimodale."""
     # La clé API est maintenant passée directement
-    llm = ChatOpenAI(model="gpt-4o", temperature=0.0, max_tokens=4000, openai_api_key=OPENAI_API_KEY)
+    llm = ChatOpenAI(model="gpt-4o", temperature=0.0, max_tokens=4000,
+                     max_retries=MAX_RETRIES, openai_api_key=OPENAI_API_KEY)
     structured_llm = llm.with_structured_output(StructuredContent)
     return structured_llm
 
@@ -130,49 +146,128 @@ def to_markdown(data: StructuredContent) -> str:
 
 # --- 5. Orchestrateur Principal ---
 
-def main():
-    logging.info("===== DÉBUT DU SCRIPT D'EXTRACTION VISION AVEC GPT-4o =====")
-    os.makedirs(BASE_OUTPUT_DIR, exist_ok=True)
-
-    extraction_chain = get_structured_extraction_chain()
-
-    files_to_process = []
-    for ext in SUPPORTED_EXTENSIONS:
-        files_to_process.extend(glob.glob(os.path.join(BASE_INPUT_DIR, '**', f"*{ext}"), recursive=True))
-
-    logging.info(f"{len(files_to_process)} fichier(s) à traiter.")
-
-    for filepath in files_to_process:
-        logging.info(f"--- Traitement de : {os.path.basename(filepath)} ---")
-        
-        base64_images = get_images_from_file(filepath)
+def list_input_files() -> List[str]:
+    """Parcourt BASE_INPUT_DIR une seule fois et retourne les fichiers dont l'extension est supportée."""
+    extensions = tuple(SUPPORTED_EXTENSIONS)
+    files = []
+    # Comme glob, on suit les liens symboliques vers des dossiers
+    for root, dirs, names in os.walk(BASE_INPUT_DIR, followlinks=True):
+        # Comme glob, on ignore les dossiers et fichiers cachés
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        files.extend(os.path.join(root, name) for name in names
+                     if not name.startswith('.') and name.lower().endswith(extensions))
+    return files
+
+def get_output_path(filepath: str) -> str:
+    """Retourne le chemin du fichier Markdown produit pour un fichier source, en conservant l'arborescence."""
+    relative_path = os.path.relpath(os.path.dirname(filepath), BASE_INPUT_DIR)
+    base_name = os.path.splitext(os.path.basename(filepath))[0]
+    return os.path.normpath(os.path.join(BASE_OUTPUT_DIR, relative_path, f"{base_name}.md"))
+
+def get_existing_outputs() -> Set[str]:
+    """Liste en une seule passe les fichiers Markdown déjà produits lors d'une exécution précédente."""
+    return {
+        os.path.normcase(os.path.normpath(os.path.join(root, name)))
+        for root, _, names in os.walk(BASE_OUTPUT_DIR)
+        for name in names
+        if name.endswith('.md')
+    }
+
+def write_file_atomically(path: str, content: str):
+    """Écrit dans un fichier temporaire du même dossier puis le renomme, pour ne jamais laisser un fichier tronqué."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        # open() applique l'umask habituel, contrairement à tempfile.mkstemp qui crée toujours en 0600
+        with open(tmp_path, 'x', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+async def process_file(extraction_chain, filepath: str, semaphore: asyncio.Semaphore,
+                       render_semaphore: asyncio.Semaphore) -> bool:
+    """Traite un fichier : conversion en images, extraction GPT-4o Vision et sauvegarde en Markdown.
+    Retourne True si le fichier Markdown a été écrit."""
+    async with semaphore:
+        logging.info("--- Traitement de : %s ---", os.path.basename(filepath))
+
+        # La conversion PDF -> images est bloquante : on l'exécute hors de la boucle d'événements,
+        # et une seule à la fois (MAX_CONCURRENT_RENDERS) puisqu'elle occupe déjà tous les cœurs
+        async with render_semaphore:
+            base64_images = await asyncio.to_thread(get_images_from_file, filepath)
 
         if not base64_images:
-            logging.warning(f"Aucune image n'a pu être extraite de {filepath}, fichier ignoré.")
-            continue
+            logging.warning("Aucune image n'a pu être extraite de %s, fichier ignoré.", filepath)
+            return False
 
         try:
             prompt = build_multimodal_prompt(base64_images, filepath)
-            # Correction ici : l'appel à invoke doit prendre une liste de messages
-            structured_data = extraction_chain.invoke([prompt])
+            # L'appel à ainvoke doit prendre une liste de messages
+            structured_data = await extraction_chain.ainvoke([prompt])
             markdown_content = to_markdown(structured_data)
 
             # Sauvegarde
-            relative_path = os.path.relpath(os.path.dirname(filepath), BASE_INPUT_DIR)
-            output_dir = os.path.join(BASE_OUTPUT_DIR, relative_path)
-            os.makedirs(output_dir, exist_ok=True)
-            base_name = os.path.splitext(os.path.basename(filepath))[0]
-            md_filename = f"{base_name}.md"
-            md_filepath = os.path.join(output_dir, md_filename)
+            md_filepath = get_output_path(filepath)
+            os.makedirs(os.path.dirname(md_filepath), exist_ok=True)
 
-            with open(md_filepath, 'w', encoding='utf-8') as f:
-                f.write(markdown_content)
-            logging.info(f"Succès GPT-4o Vision -> MD : {md_filepath}")
+            write_file_atomically(md_filepath, markdown_content)
+            logging.info("Succès GPT-4o Vision -> MD : %s", md_filepath)
+            return True
 
         except Exception as e:
-            logging.error(f"ERREUR lors du traitement GPT-4o Vision pour {filepath}. Raison : {e}", exc_info=True)
+            logging.error("ERREUR lors du traitement GPT-4o Vision pour %s. Raison : %s", filepath, e, exc_info=True)
+            return False
+
+async def process_first_success(extraction_chain, filepaths: List[str], semaphore: asyncio.Semaphore,
+                                render_semaphore: asyncio.Semaphore):
+    """Traite des fichiers qui produisent le même fichier Markdown, par ordre de priorité,
+    en s'arrêtant au premier succès : un seul appel GPT-4o payé par fichier de sortie."""
+    for filepath in filepaths:
+        if await process_file(extraction_chain, filepath, semaphore, render_semaphore):
+            return
+
+async def main():
+    logging.info("===== DÉBUT DU SCRIPT D'EXTRACTION VISION AVEC GPT-4o =====")
+    os.makedirs(BASE_OUTPUT_DIR, exist_ok=True)
+
+    extraction_chain = get_structured_extraction_chain()
+
+    files_to_process = list_input_files()
+
+    # Reprise : on ne repaie pas un appel GPT-4o pour un fichier déjà converti
+    if OVERWRITE_EXISTING:
+        pending_files = files_to_process
+    else:
+        existing_outputs = get_existing_outputs()
+        pending_files = [f for f in files_to_process if os.path.normcase(get_output_path(f)) not in existing_outputs]
+        skipped = len(files_to_process) - len(pending_files)
+        if skipped:
+            logging.info("%d fichier(s) déjà converti(s), ignoré(s) (OVERWRITE_EXISTING = False).", skipped)
+
+    logging.info("%d fichier(s) à traiter.", len(pending_files))
+
+    # Des fichiers de même nom dans un dossier (ex. a.pdf et a.png) produisent le même a.md : seule la dernière
+    # extension dans l'ordre de SUPPORTED_EXTENSIONS est traitée (elle l'emportait déjà avant), les autres
+    # ne servent que de repli si son extraction échoue
+    groups = {}
+    for filepath in pending_files:
+        groups.setdefault(os.path.normcase(get_output_path(filepath)), []).append(filepath)
+    for md_filepath, filepaths in groups.items():
+        if len(filepaths) > 1:
+            filepaths.sort(key=lambda f: SUPPORTED_EXTENSIONS.index(os.path.splitext(f)[1].lower()), reverse=True)
+            logging.warning("%d fichiers produisent le même fichier %s : %s est utilisé, %s en repli", len(filepaths),
+                            md_filepath, os.path.basename(filepaths[0]),
+                            ", ".join(os.path.basename(f) for f in filepaths[1:]))
+
+    # Les appels à l'API sont limités par le réseau : on les chevauche, dans la limite du sémaphore
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    render_semaphore = asyncio.Semaphore(MAX_CONCURRENT_RENDERS)
+    await asyncio.gather(*(process_first_success(extraction_chain, filepaths, semaphore, render_semaphore)
+                           for filepaths in groups.values()))
 
     logging.info("\n===== SCRIPT TERMINÉ =====")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())